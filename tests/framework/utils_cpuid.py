@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0
 """Helper functions for testing CPU identification functionality."""
 
+import functools
 import subprocess
 from enum import Enum, auto
 
@@ -24,6 +25,7 @@ def get_cpu_vendor():
     return CpuVendor.INTEL
 
 
+@functools.lru_cache()
 def get_cpu_model_name():
     """Return the CPU model name."""
     _, stdout, _ = run_cmd("cat /proc/cpuinfo | grep 'model name' | uniq")
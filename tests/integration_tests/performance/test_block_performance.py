@@ -2,9 +2,11 @@
 # SPDX-License-Identifier: Apache-2.0
 """Performance benchmark for block device emulation."""
 import concurrent
+import csv
 import json
 import logging
 import os
+from collections import defaultdict
 from enum import Enum
 import shutil
 import pytest
@@ -31,8 +33,14 @@ FIO = "fio"
 CPU_UTILIZATION_VMM = "cpu_utilization_vmm"
 CPU_UTILIZATION_VMM_SAMPLES_TAG = "cpu_utilization_vmm_samples"
 CPU_UTILIZATION_VCPUS_TOTAL = "cpu_utilization_vcpus_total"
-CONFIG = json.load(open(defs.CFG_LOCATION /
-                        "block_performance_test_config.json"))
+with open(defs.CFG_LOCATION /
+          "block_performance_test_config.json") as config_file:
+    CONFIG = json.load(config_file)
+# Baselines of the host instance, keyed by CPU model name.
+CPU_BASELINES = {
+    cpu_baseline["model"]: cpu_baseline
+    for cpu_baseline in CONFIG["hosts"]["instances"]["m5d.metal"]["cpus"]
+}
 
 
 # pylint: disable=R0903
@@ -41,20 +49,15 @@ class BlockBaselinesProvider(BaselineProvider):
 
     def __init__(self, env_id, fio_id):
         """Block baseline provider initialization."""
-        cpu_model_name = get_cpu_model_name()
-        baselines = list(filter(
-            lambda cpu_baseline: cpu_baseline["model"] == cpu_model_name,
-            CONFIG["hosts"]["instances"]["m5d.metal"]["cpus"]))
+        baselines = CPU_BASELINES.get(get_cpu_model_name(), dict())
+        super().__init__(DictQuery(baselines))
 
-        super().__init__(DictQuery(dict()))
-        if len(baselines) > 0:
-            super().__init__(DictQuery(baselines[0]))
-
-        self._tag = "baselines/{}/" + env_id + "/{}/" + fio_id
+        self._env_id = env_id
+        self._fio_id = fio_id
 
     def get(self, ms_name: str, st_name: str) -> dict:
         """Return the baseline value corresponding to the key."""
-        key = self._tag.format(ms_name, st_name)
+        key = f"baselines/{ms_name}/{self._env_id}/{st_name}/{self._fio_id}"
         baseline = self._baselines.get(key)
         if baseline:
             target = baseline.get("target")
@@ -66,7 +69,15 @@ class BlockBaselinesProvider(BaselineProvider):
         return None
 
 
-def run_fio(env_id, basevm, ssh_conn, mode, bs):
+def reset_dir(path):
+    """Remove the directory at `path`, if any, and create it empty."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+    os.makedirs(path)
+
+
+def run_fio(env_id, basevm, ssh_conn, mode, bs, executor):
     """Run a fio test in the specified mode with block size bs."""
     logs_path = f"{basevm.jailer.chroot_base_with_id()}/{env_id}/{mode}{bs}"
 
@@ -91,69 +102,64 @@ def run_fio(env_id, basevm, ssh_conn, mode, bs):
         .with_arg("--output-format=json+") \
         .build()
 
-    rc, _, stderr = ssh_conn.execute_command(
-        "echo 'none' > /sys/block/vdb/queue/scheduler")
-    assert rc == 0, stderr.read()
-    assert stderr.read() == ""
-
     run_cmd("echo 3 > /proc/sys/vm/drop_caches")
 
     rc, _, stderr = ssh_conn.execute_command(
-        "echo 3 > /proc/sys/vm/drop_caches")
-    assert rc == 0, stderr.read()
-    assert stderr.read() == ""
+        "echo 'none' > /sys/block/vdb/queue/scheduler"
+        " && echo 3 > /proc/sys/vm/drop_caches")
+    err = stderr.read()
+    assert rc == 0, err
+    assert err == ""
 
     # Start the CPU load monitor.
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        cpu_load_future = executor.submit(get_cpu_percent,
-                                          basevm.jailer_clone_pid,
-                                          CONFIG["time"],
-                                          omit=CONFIG["omit"])
-
-        # Print the fio command in the log and run it
-        rc, _, stderr = ssh_conn.execute_command(cmd)
-        assert rc == 0, stderr.read()
-        assert stderr.read() == ""
-
-        if os.path.isdir(logs_path):
-            shutil.rmtree(logs_path)
-
-        os.makedirs(logs_path)
-
-        ssh_conn.scp_get_file("*.log", logs_path)
-        rc, _, stderr = ssh_conn.execute_command("rm *.log")
-        assert rc == 0, stderr.read()
-
-        result = dict()
-        cpu_load = cpu_load_future.result()
-        tag = "firecracker"
+    cpu_load_future = executor.submit(get_cpu_percent,
+                                      basevm.jailer_clone_pid,
+                                      CONFIG["time"],
+                                      omit=CONFIG["omit"])
+
+    # Print the fio command in the log and run it
+    rc, _, stderr = ssh_conn.execute_command(cmd)
+    err = stderr.read()
+    assert rc == 0, err
+    assert err == ""
+
+    reset_dir(logs_path)
+
+    ssh_conn.scp_get_file("*.log", logs_path)
+    rc, _, stderr = ssh_conn.execute_command("rm *.log")
+    err = stderr.read()
+    assert rc == 0, err
+
+    result = dict()
+    cpu_load = cpu_load_future.result()
+    tag = "firecracker"
+    assert tag in cpu_load and len(cpu_load[tag]) == 1
+
+    data = next(iter(cpu_load[tag].values()))
+    data_len = len(data)
+    assert data_len == CONFIG["time"]
+
+    result[CPU_UTILIZATION_VMM] = sum(data) / data_len
+    if DEBUG:
+        result[CPU_UTILIZATION_VMM_SAMPLES_TAG] = data
+
+    vcpus_util = 0
+    for vcpu in range(basevm.vcpus_count):
+        # We expect a single fc_vcpu thread tagged with
+        # f`fc_vcpu {vcpu}`.
+        tag = f"fc_vcpu {vcpu}"
         assert tag in cpu_load and len(cpu_load[tag]) == 1
-
-        data = list(cpu_load[tag].values())[0]
+        data = next(iter(cpu_load[tag].values()))
         data_len = len(data)
-        assert data_len == CONFIG["time"]
 
-        result[CPU_UTILIZATION_VMM] = sum(data) / data_len
+        assert data_len == CONFIG["time"]
         if DEBUG:
-            result[CPU_UTILIZATION_VMM_SAMPLES_TAG] = data
-
-        vcpus_util = 0
-        for vcpu in range(basevm.vcpus_count):
-            # We expect a single fc_vcpu thread tagged with
-            # f`fc_vcpu {vcpu}`.
-            tag = f"fc_vcpu {vcpu}"
-            assert tag in cpu_load and len(cpu_load[tag]) == 1
-            data = list(cpu_load[tag].values())[0]
-            data_len = len(data)
-
-            assert data_len == CONFIG["time"]
-            if DEBUG:
-                samples_tag = f"cpu_utilization_fc_vcpu_{vcpu}_samples"
-                result[samples_tag] = data
-            vcpus_util += sum(data) / data_len
+            samples_tag = f"cpu_utilization_fc_vcpu_{vcpu}_samples"
+            result[samples_tag] = data
+        vcpus_util += sum(data) / data_len
 
-        result[CPU_UTILIZATION_VCPUS_TOTAL] = vcpus_util
-        return result
+    result[CPU_UTILIZATION_VCPUS_TOTAL] = vcpus_util
+    return result
 
 
 class DataDirection(Enum):
@@ -165,16 +171,25 @@ class DataDirection(Enum):
 
     def __str__(self):
         """Representation as string."""
-        # pylint: disable=W0143
-        if self.value == 0:
-            return "read"
-        # pylint: disable=W0143
-        if self.value == 1:
-            return "write"
-        # pylint: disable=W0143
-        if self.value == 2:
-            return "trim"
-        return ""
+        return self.name.lower()
+
+
+def read_job_values(file_path, measurement, direction_count):
+    """Read the values logged by a single fio job.
+
+    Return a dict mapping each measurement id to the values logged for it,
+    keyed by sample index.
+    """
+    values = defaultdict(dict)
+    measurement_ids = {data_dir.value: f"{measurement}_{str(data_dir)}"
+                       for data_dir in DataDirection}
+
+    with open(file_path) as file:
+        for idx, data in enumerate(csv.reader(file)):
+            measurement_id = measurement_ids[int(data[2])]
+            values[measurement_id][idx // direction_count] = int(data[1])
+
+    return values
 
 
 def read_values(cons, numjobs, env_id, mode, bs, measurement, logs_path):
@@ -184,39 +199,33 @@ def read_values(cons, numjobs, env_id, mode, bs, measurement, logs_path):
     The log file format documentation can be found here:
     https://fio.readthedocs.io/en/latest/fio_doc.html#log-file-formats
     """
-    values = dict()
+    direction_count = 1
+    if mode.endswith("readwrite") or mode.endswith("rw"):
+        direction_count = 2
 
-    for job_id in range(numjobs):
-        file_path = f"{logs_path}/{env_id}/{mode}{bs}/{mode}" \
-            f"{bs}_{measurement}.{job_id + 1}.log"
-        file = open(file_path)
-        lines = file.readlines()
+    # Maps each measurement id and sample index to the values reported by
+    # all jobs.
+    values = defaultdict(lambda: defaultdict(list))
 
-        direction_count = 1
-        if mode.endswith("readwrite") or mode.endswith("rw"):
-            direction_count = 2
+    file_paths = [f"{logs_path}/{env_id}/{mode}{bs}/{mode}"
+                  f"{bs}_{measurement}.{job_id + 1}.log"
+                  for job_id in range(numjobs)]
 
-        for idx in range(0, len(lines), direction_count):
-            value_idx = idx//direction_count
-            for direction in range(direction_count):
-                data = lines[idx + direction].split(sep=",")
-                data_dir = DataDirection(int(data[2].strip()))
+    jobs_values = [read_job_values(file_path, measurement, direction_count)
+                   for file_path in file_paths]
 
-                measurement_id = f"{measurement}_{str(data_dir)}"
-                if measurement_id not in values:
-                    values[measurement_id] = dict()
-
-                if value_idx not in values[measurement_id]:
-                    values[measurement_id][value_idx] = list()
-                values[measurement_id][value_idx].append(int(data[1].strip()))
+    for job_values in jobs_values:
+        for measurement_id, job_samples in job_values.items():
+            for value_idx, value in job_samples.items():
+                values[measurement_id][value_idx].append(value)
 
     for measurement_id in values:
-        for idx in values[measurement_id]:
+        for samples in values[measurement_id].values():
             # Discard data points which were not measured by all jobs.
-            if len(values[measurement_id][idx]) != numjobs:
+            if len(samples) != numjobs:
                 continue
 
-            value = sum(values[measurement_id][idx])
+            value = sum(samples)
             if DEBUG:
                 cons.consume_custom(measurement_id, value)
             cons.consume_data(measurement_id, value)
@@ -313,26 +322,31 @@ def fio_workload(context):
     ssh_connection = net_tools.SSHConnection(basevm.ssh_config)
     env_id = f"{context.kernel.name()}/{context.disk.name()}"
 
-    for mode in CONFIG["fio_modes"]:
-        for bs in CONFIG["fio_blk_sizes"]:
-            fio_id = f"{mode}-bs{bs}-{basevm.vcpus_count}vcpu"
-            st_prod = st.producer.LambdaProducer(
-                func=run_fio,
-                func_kwargs={"env_id": env_id, "basevm": basevm,
-                             "ssh_conn": ssh_connection, "mode": mode,
-                             "bs": bs})
-            st_cons = st.consumer.LambdaConsumer(
-                metadata_provider=DictMetadataProvider(
-                    CONFIG["measurements"],
-                    BlockBaselinesProvider(env_id,
-                                           fio_id)),
-                func=consume_fio_output,
-                func_kwargs={"numjobs": basevm.vcpus_count, "mode": mode,
-                             "bs": bs, "env_id": env_id,
-                             "logs_path": basevm.jailer.chroot_base_with_id()})
-            st_core.add_pipe(st_prod, st_cons, tag=f"{env_id}/{fio_id}")
-
-    result = st_core.run_exercise(file_dumper is None)
+    # A single worker is enough, since the runs are sequential and each
+    # of them only monitors the CPU load in the background.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        for mode in CONFIG["fio_modes"]:
+            for bs in CONFIG["fio_blk_sizes"]:
+                fio_id = f"{mode}-bs{bs}-{basevm.vcpus_count}vcpu"
+                st_prod = st.producer.LambdaProducer(
+                    func=run_fio,
+                    func_kwargs={"env_id": env_id, "basevm": basevm,
+                                 "ssh_conn": ssh_connection, "mode": mode,
+                                 "bs": bs, "executor": executor})
+                st_cons = st.consumer.LambdaConsumer(
+                    metadata_provider=DictMetadataProvider(
+                        CONFIG["measurements"],
+                        BlockBaselinesProvider(env_id,
+                                               fio_id)),
+                    func=consume_fio_output,
+                    func_kwargs={"numjobs": basevm.vcpus_count,
+                                 "mode": mode, "bs": bs, "env_id": env_id,
+                                 "logs_path":
+                                     basevm.jailer.chroot_base_with_id()})
+                st_core.add_pipe(st_prod, st_cons, tag=f"{env_id}/{fio_id}")
+
+        result = st_core.run_exercise(file_dumper is None)
+
     if file_dumper:
         file_dumper.writeln(json.dumps(result))
     basevm.kill()
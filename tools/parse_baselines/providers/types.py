@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0
 """Define data types and abstractions for parsers."""
 
+import functools
 import json
 from abc import abstractmethod, ABC
 from collections.abc import Iterator
@@ -9,6 +10,12 @@ from collections import defaultdict
 from typing import AnyStr
 from typing import List
 
+# Prefer the faster orjson parser for the data lines, when it is available.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 # pylint: disable=R0903
 
@@ -17,6 +24,29 @@ def nested_dict():
     return defaultdict(nested_dict)
 
 
+def json_loads(line: AnyStr):
+    """Decode a line of JSON data.
+
+    orjson rejects the `NaN` and `Infinity` values emitted by `json.dumps`,
+    so such lines are decoded by the standard library parser instead.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(line)  # pylint: disable=no-member
+        except orjson.JSONDecodeError:  # pylint: disable=no-member
+            pass
+    return json.loads(line)
+
+
+@functools.lru_cache(maxsize=None)
+def split_tag(tag: str) -> tuple:
+    """Split a measurement tag into its components.
+
+    Tags repeat across data lines, so each distinct tag is split only once.
+    """
+    return tuple(tag.split("/"))
+
+
 class FileDataProvider(Iterator):
     """File based data provider."""
 
@@ -30,7 +60,7 @@ class FileDataProvider(Iterator):
 
     def __next__(self) -> AnyStr:
         """Get a line of data from the file."""
-        return self._file.readline()
+        return next(self._file)
 
 
 class DataParser(ABC):
@@ -49,49 +79,39 @@ class DataParser(ABC):
 
     def _format_baselines(self) -> List[dict]:
         """Return the computed baselines into the right serializable format."""
-        baselines = dict()
-
-        for cpu_model in self._data:
-            baselines[cpu_model] = {
-                'model': cpu_model, **self._data[cpu_model]}
+        return [{'model': cpu_model, **self._data[cpu_model]}
+                for cpu_model in self._data]
 
-        temp_baselines = baselines
-        baselines = []
-
-        for cpu_model in self._data:
-            baselines.append(temp_baselines[cpu_model])
-
-        return baselines
-
-    def _populate_baselines(self, key, parent):
+    def _populate_baselines(self, data):
         """Traverse the data dict and compute the baselines."""
-        # Initial case.
-        if key is None:
-            for k in parent:
-                self._populate_baselines(k, parent)
-            return
+        stack = [(data, key) for key in data]
+        while stack:
+            parent, key = stack.pop()
 
-        # Base case, reached a data list.
-        if isinstance(parent[key], list):
-            parent[key] = self.calculate_baseline(parent[key])
-            return
+            # Reached a data list.
+            if isinstance(parent[key], list):
+                parent[key] = self.calculate_baseline(parent[key])
+                continue
 
-        # Recurse for all children.
-        for k in parent[key]:
-            self._populate_baselines(k, parent[key])
+            # Visit all children.
+            stack.extend((parent[key], k) for k in parent[key])
 
     def parse(self) -> dict:
         """Parse the rows and return baselines."""
-        line = next(self._data_provider)
-        while line:
-            json_line = json.loads(line)
+        baselines_defs = [key.split("/") for key in self._baselines_defs]
+
+        for line in self._data_provider:
+            json_line = json_loads(line)
             measurements = json_line['results']
             cpu_model = json_line['custom']['cpu_model_name']
 
             # Consume the data and aggregate into lists.
             for tag in measurements.keys():
-                for key in self._baselines_defs:
-                    [ms_name, st_name] = key.split("/")
+                [kernel_version,
+                 rootfs_type,
+                 test_config] = split_tag(tag)
+
+                for [ms_name, st_name] in baselines_defs:
                     ms_data = measurements[tag].get(ms_name)
 
                     if ms_data is None:
@@ -99,18 +119,14 @@ class DataParser(ABC):
 
                     st_data = ms_data.get(st_name)
 
-                    [kernel_version,
-                     rootfs_type,
-                     test_config] = tag.split("/")
-
                     data = self._data[cpu_model][ms_name]
                     data = data[kernel_version][rootfs_type][st_name]
-                    if isinstance(data[test_config], list):
-                        data[test_config].append(st_data)
-                    else:
+                    samples = data.get(test_config)
+                    if samples is None:
                         data[test_config] = [st_data]
-            line = next(self._data_provider)
+                    else:
+                        samples.append(st_data)
 
-        self._populate_baselines(None, self._data)
+        self._populate_baselines(self._data)
 
         return self._format_baselines()